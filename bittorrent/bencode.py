@@ -1,69 +1,301 @@
-from typing import Union
+from operator import itemgetter
+from typing import Union, Optional, Callable
 
 BenType = Union[int, bytes, list['BenType'], dict[str, 'BenType']]
 
+# token bytes, compared as ints so decoding never builds a str per token
+_INT, _LIST, _DICT, _END, _ZERO, _NINE = b'ilde09'
+
+# length headers of the short strings that make up most keys and values
+_LEN_PREFIX = tuple(b'%d:' % length for length in range(256))
+# encodings of the small non-negative ints (flags, counts, indices)
+_SMALL_INTS = tuple(b'i%de' % value for value in range(256))
+
 
 def bencode(data: BenType) -> bytes:
-    if isinstance(data, int):
-        return f'i{data}e'.encode()
+    # one growing buffer, frozen to bytes once at the end
+    binary = bytearray()
+    (_ENCODERS.get(type(data)) or _encoder(data))(data, binary)
+    return bytes(binary)
 
-    if isinstance(data, str):
-        return f'{len(data)}:{data}'.encode()
 
-    if isinstance(data, bytes):
-        return f'{len(data)}:'.encode() + data
+def _encoder(data: BenType) -> Callable[[BenType, bytearray], None]:
+    # fallback for subclasses (IntEnum, ...) that miss the exact-type lookup
+    for _type, encoder in _ENCODERS.items():
+        if isinstance(data, _type):
+            return encoder
+    raise ValueError(f'Type {type(data)} not supported.')
 
-    if isinstance(data, list):
-        values = b''.join(bencode(x) for x in data)
-        return b'l' + values + b'e'
 
-    if isinstance(data, dict):
-        values = b''.join(bencode(k) + bencode(v) for k, v in data.items())
-        return b'd' + values + b'e'
+def _encode_int(data: int, buffer: bytearray):
+    buffer += _SMALL_INTS[data] if 0 <= data < 256 else b'i%de' % data
+
+
+def _encode_str(data: str, buffer: bytearray):
+    _encode_bytes(data.encode(), buffer)
+
+
+def _encode_bytes(data: bytes, buffer: bytearray):
+    length = len(data)
+    buffer += _LEN_PREFIX[length] if length < 256 else b'%d:' % length
+    buffer += data
+
+
+def _encode_list(data: list[BenType], buffer: bytearray):
+    buffer += b'l'
+    for x in data:
+        (_ENCODERS.get(type(x)) or _encoder(x))(x, buffer)
+    buffer += b'e'
+
+
+def _encode_dict(data: dict[str, BenType], buffer: bytearray):
+    items: list[tuple[bytes, BenType]] = list()
+    for k, v in data.items():
+        key = k.encode() if isinstance(k, str) else k
+        if not isinstance(key, bytes):
+            raise ValueError('Dict key should be a bytes string.')
+        items.append((key, v))
+
+    # keys are sorted as raw bytes
+    buffer += b'd'
+    for key, v in sorted(items, key=itemgetter(0)):
+        length = len(key)
+        buffer += _LEN_PREFIX[length] if length < 256 else b'%d:' % length
+        buffer += key
+        (_ENCODERS.get(type(v)) or _encoder(v))(v, buffer)
+    buffer += b'e'
 
-    raise ValueError(f'Type {type(data)} not supported.')
+
+# encoder for each supported type, looked up by exact type; _encoder scans
+# it in order for subclasses, bool encodes as the int it is
+_ENCODERS: dict[type, Callable[[BenType, bytearray], None]] = {
+    int: _encode_int,
+    bytes: _encode_bytes,
+    str: _encode_str,
+    list: _encode_list,
+    dict: _encode_dict,
+    bool: _encode_int,
+    tuple: _encode_list,
+}
 
 
 def decode_bencode(data: bytes) -> BenType:
+    if len(data) == 0:
+        return b''
+
     value, size = _decode_bencode(data)
-    assert size == len(data)
+    if size != len(data):
+        raise ValueError('Trailing data after top-level value.')
     return value
 
 
+def decode_bencode_spans(data: bytes) -> tuple[dict[str, BenType], dict[str, tuple[int, int]]]:
+    # decodes a top-level dict and also returns the (start, end) byte span
+    # of each value in data, so a value can be hashed without re-encoding it
+    if data[:1] != b'd':
+        raise ValueError('Top-level value should be a dict.')
+
+    _dict: dict[str, BenType] = {}
+    spans: dict[str, tuple[int, int]] = {}
+    start = 1
+    while start < len(data) and data[start] != _END:
+        key, start = _decode_bencode(data, start)
+        if not isinstance(key, bytes):
+            raise ValueError('Dict key should be a bytes string.')
+        value, end = _decode_bencode(data, start)
+        _dict[key.decode()] = value
+        spans[key.decode()] = (start, end)
+        start = end
+    if start == len(data):
+        raise ValueError('Unexpected end of data.')
+    if start + 1 != len(data):
+        raise ValueError('Trailing data after top-level value.')
+    return _dict, spans
+
+
+class BDecoder:
+    # incremental decoder, feed() takes data as it arrives and returns every
+    # top-level value it completes; containers still open stay on the stack
+    # between calls, so only a token cut by the end of a chunk is re-read
+    def __init__(self):
+        self.buffer = b''
+        self.chunks: list[bytes] = list()
+        self.size = 0
+        # bytes needed before the cut token can possibly be complete
+        self.needed = 1
+        self.stack: list[Union[list[BenType], dict[str, BenType]]] = list()
+        self.keys: list[Union[str, None, object]] = list()
+        self.key_cache: dict[bytes, str] = dict()
+
+
+    def feed(self, data: bytes) -> list[BenType]:
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size < self.needed:
+            return []
+
+        data = b''.join([self.buffer, *self.chunks])
+        self.chunks.clear()
+        values: list[BenType] = list()
+        start = 0
+        while start < len(data):
+            try:
+                value, start = _decode(data, start, self.stack, self.keys, self.key_cache)
+            except _Incomplete as e:
+                self.buffer = data[e.start:]
+                self.size = len(self.buffer)
+                self.needed = e.end - e.start
+                return values
+            except ValueError:
+                # the half-built containers can't be resumed, drop them along
+                # with the rest of the data so the next feed starts afresh
+                self._reset()
+                raise
+            values.append(value)
+            self.key_cache.clear()
+
+        self._reset()
+        return values
+
+
+    def _reset(self):
+        self.buffer = b''
+        self.size = 0
+        self.needed = 1
+        self.stack.clear()
+        self.keys.clear()
+        self.key_cache.clear()
+
+
+class _Incomplete(ValueError):
+    # the token at start needs data up to end
+    def __init__(self, end: int):
+        super().__init__('Unexpected end of data.')
+        self.start = 0
+        self.end = end
+
+
+# marks a dict whose next key hasn't been read yet
+_PENDING_KEY = object()
+
+
 def _decode_bencode(data: bytes, start: int = 0) -> tuple[BenType, int]:
-    if len(data) == 0:
-        return (b'', 0)
-
-    char = chr(data[start])
-
-    if char.isdigit():
-        idx = data.find(':'.encode(), start)
-        length = int(data[start:idx])
-        value = data[idx + 1:idx + 1 + length]
-        return (value, idx + length + 1)
-
-    if char == 'i':
-        idx = data.find('e'.encode(), start)
-        value = int(data[start + 1:idx] or 0)
-        return (value, idx + 1)
-
-    if char == 'l':
-        _list: list[BenType] = list()
-        start += 1
-        while chr(data[start]) != 'e':
-            value, start = _decode_bencode(data, start)
-            _list.append(value)
-        return (_list, start + 1)
-
-    if char == 'd':
-        _dict: dict[str, BenType] = {}
-        start += 1
-        while chr(data[start]) != 'e':
-            key, start = _decode_bencode(data, start)
-            if not isinstance(key, bytes):
-                raise ValueError('Dict key should be a bytes string.')
-            value, start = _decode_bencode(data, start)
-            _dict[key.decode()] = value
-        return (_dict, start + 1)
-
-    raise ValueError(f'Character "{char}" not recognized.')
+    # the few distinct keys repeat across every dict (path, length, ...),
+    # each is decoded once and the same str object is shared
+    return _decode(data, start, list(), list(), dict())
+
+
+def _decode(
+    data: bytes,
+    start: int,
+    stack: list[Union[list[BenType], dict[str, BenType]]],
+    keys: list[Union[str, None, object]],
+    key_cache: dict[bytes, str]
+) -> tuple[BenType, int]:
+    # containers being filled live on an explicit stack instead of nested
+    # calls, keys holds the key awaiting its value at each level (None for
+    # lists, and for dicts about to close); start always points at the
+    # token being read, which is where decoding resumes after _Incomplete
+    try:
+        if keys and keys[-1] is _PENDING_KEY:
+            keys[-1], start = _decode_key(data, start, key_cache)
+
+        while True:
+            char = data[start]
+            decoder = _DECODERS[char]
+            if decoder:
+                value, start = decoder(data, start)
+
+            elif char == _LIST:
+                stack.append(list())
+                keys.append(None)
+                start += 1
+                continue
+
+            elif char == _DICT:
+                stack.append(dict())
+                keys.append(_PENDING_KEY)
+                start += 1
+                keys[-1], start = _decode_key(data, start, key_cache)
+                continue
+
+            elif stack:
+                if keys[-1] is not None:
+                    raise ValueError('Dict key should be followed by a value.')
+                keys.pop()
+                value = stack.pop()
+                start += 1
+
+            else:
+                raise ValueError('Character "e" not recognized.')
+
+            if not stack:
+                return (value, start)
+
+            key = keys[-1]
+            if key is None:
+                stack[-1].append(value)
+            else:
+                stack[-1][key] = value
+                keys[-1] = _PENDING_KEY
+                keys[-1], start = _decode_key(data, start, key_cache)
+
+    except IndexError:
+        error = _Incomplete(start + 1)
+        error.start = start
+        raise error from None
+    except _Incomplete as error:
+        error.start = start
+        raise
+
+
+def _decode_key(data: bytes, start: int, key_cache: dict[bytes, str]) -> tuple[Optional[str], int]:
+    char = data[start]
+    if char == _END:
+        return (None, start)
+    if not _ZERO <= char <= _NINE:
+        raise ValueError('Dict key should be a bytes string.')
+    idx = data.find(b':', start)
+    if idx < 0:
+        raise _Incomplete(len(data) + 1)
+    end = idx + 1 + int(data[start:idx])
+    if end > len(data):
+        raise _Incomplete(end)
+    raw = data[idx + 1:end]
+    key = key_cache.get(raw)
+    if key is None:
+        key = key_cache[raw] = raw.decode()
+    return (key, end)
+
+
+def _decode_string(data: bytes, start: int) -> tuple[bytes, int]:
+    idx = data.find(b':', start)
+    if idx < 0:
+        raise _Incomplete(len(data) + 1)
+    end = idx + 1 + int(data[start:idx])
+    if end > len(data):
+        raise _Incomplete(end)
+    return (data[idx + 1:end], end)
+
+
+def _decode_int(data: bytes, start: int) -> tuple[int, int]:
+    idx = data.find(b'e', start + 1)
+    if idx < 0:
+        raise _Incomplete(len(data) + 1)
+    value = int(data[start + 1:idx]) if idx > start + 1 else 0
+    return (value, idx + 1)
+
+
+def _decode_invalid(data: bytes, start: int) -> tuple[BenType, int]:
+    raise ValueError(f'Character "{chr(data[start])}" not recognized.')
+
+
+# decoder for each possible first byte of a leaf value, None for the list,
+# dict and end bytes which _decode_bencode handles itself
+_DECODERS: tuple[Optional[Callable[[bytes, int], tuple[BenType, int]]], ...] = tuple(
+    _decode_string if _ZERO <= char <= _NINE else
+    _decode_int if char == _INT else
+    None if char in (_LIST, _DICT, _END) else
+    _decode_invalid
+    for char in range(256)
+)
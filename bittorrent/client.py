@@ -1,13 +1,22 @@
 import os
+import sys
 import random
+import asyncio
 import logging
-from threading import Lock
-from typing import Optional
+from typing import Optional, BinaryIO
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 from bittorrent.trackers import Trackers
 from bittorrent.torrent import Torrent, Piece, File
-from bittorrent.peer import Peer, Bitfield
+from bittorrent.peer import Peer, Bitfield, make_handshake
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# sendfile only copies between regular files on linux, elsewhere the
+# destination has to be a socket
+_USE_SENDFILE = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
 
 
 class Client:
@@ -29,10 +38,12 @@ class Client:
         self.piece_chunk_size = piece_chunk_size
         self.max_peers_per_piece = max_peers_per_piece
         self.peer_id = random.randbytes(20)
-        self.work_queue: set[Piece] = set()
+        self.work_queue = Bitfield(bytearray((torrent.piece_count + 7) // 8))
         self.work_done: set[Piece] = set()
         self.workers_per_work: dict[Piece, list[Peer]] = defaultdict(list)
-        self.lock = Lock()
+        self.tasks: list[asyncio.Task] = list()
+        # set whenever pieces are handed back or completed, wakes idle peers
+        self.work_changed = asyncio.Event()
 
 
     def download(self, output_directory: str):
@@ -50,24 +61,24 @@ class Client:
             self.max_tracker_workers,
             self.max_peers_per_tracker
         )
-        peers = trackers.get_peers()
-
-        with ThreadPoolExecutor(max_workers=self.max_peer_workers) as executor:
-            executor.map(Peer.start, [
+        handshake = make_handshake(self.torrent.info_hash, self.peer_id)
+        loop_factory = uvloop.new_event_loop if uvloop else None
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            peers = runner.run(trackers.get_peers())
+            runner.run(self._run_peers([
                 Peer(
                     peer,
                     self._get_work,
                     self._put_work,
                     self._put_result,
                     self._has_finished,
-                    self.torrent.info_hash,
-                    self.peer_id,
+                    handshake,
                     self.torrent.piece_count,
                     self.piece_chunk_size,
                     self.max_peer_batch_requests
                 )
                 for peer in peers
-            ])
+            ]))
 
         if not self._has_finished():
             logging.error('Could not download file.')
@@ -76,65 +87,87 @@ class Client:
         self._assemble_files(files_directory)
 
 
-    def _get_work(self, peer: Peer, bitfield: Bitfield) -> Optional[Piece]:
-        with self.lock:
+    async def _run_peers(self, peers: list[Peer]):
+        semaphore = asyncio.Semaphore(self.max_peer_workers)
+        async with asyncio.TaskGroup() as group:
+            self.tasks = [group.create_task(self._run_peer(peer, semaphore)) for peer in peers]
+
+
+    async def _run_peer(self, peer: Peer, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                await peer.start()
+            except Exception:
+                logging.exception(f'Peer {peer.peer.ip}:{peer.peer.port} failed')
+
+
+    async def _get_work(self, peer: Peer, bitfield: Optional[Bitfield]) -> Optional[Piece]:
+        while not self._has_finished():
+            work = self._next_work(peer, bitfield)
+            if work:
+                return work
+            logging.debug('No work in queue')
+            self.work_changed.clear()
+            await self.work_changed.wait()
+        return None
+
+
+    def _next_work(self, peer: Peer, bitfield: Optional[Bitfield]) -> Optional[Piece]:
+        available = self.work_queue if bitfield is None else self.work_queue & bitfield
+        candidates = [
+            self.torrent.pieces[index]
+            for index in available.pieces()
+            if len(self.workers_per_work[self.torrent.pieces[index]]) < self.max_peers_per_piece
+        ]
+
+        if not candidates:
             candidates = [
                 work
-                for work in self.work_queue
-                if (
-                    (bitfield.size == 0 or bitfield.has_piece(work.index)) and
-                    len(self.workers_per_work[work]) < self.max_peers_per_piece
-                )
+                for work, workers in self.workers_per_work.items()
+                if len(workers) < self.max_peers_per_piece
+                and (bitfield is None or bitfield.has_piece(work.index))
             ]
-
             if not candidates:
-                candidates = [
-                    work
-                    for work, workers in self.workers_per_work.items()
-                    if len(workers) < self.max_peers_per_piece
-                ]
-                if not candidates:
-                    return None
+                return None
 
-            work = random.choice(candidates)
-            self.workers_per_work[work].append(peer)
-            if work in self.work_queue:
-                self.work_queue.remove(work)
+        work = random.choice(candidates)
+        self.workers_per_work[work].append(peer)
+        self.work_queue.clear_piece(work.index)
 
-            return work
+        return work
 
 
     def _put_work(self, peer: Peer, work: Piece):
-        with self.lock:
-            self.work_queue.add(work)
-            self.workers_per_work[work].remove(peer)
+        self.work_queue.set_piece(work.index)
+        self.workers_per_work[work].remove(peer)
+        self.work_changed.set()
 
 
-    def _put_result(self, peer: Peer, piece: Piece, data: bytes):
-        with self.lock:
-            if piece in self.work_queue:
-                self.work_queue.remove(piece)
+    def _put_result(self, peer: Peer, piece: Piece, data: memoryview):
+        self.work_queue.clear_piece(piece.index)
 
-            for worker in self.workers_per_work[piece]:
-                if worker != peer:
-                    worker.cancel_work()
+        for worker in self.workers_per_work[piece]:
+            if worker != peer:
+                worker.cancel_work()
 
-            del self.workers_per_work[piece]
+        del self.workers_per_work[piece]
 
-            self.work_done.add(piece)
+        self.work_done.add(piece)
+        self.work_changed.set()
 
-            if self._has_finished():
-                for workers in self.workers_per_work.values():
-                    for worker in workers:
-                        worker.cancel_work()
+        if self._has_finished():
+            current = asyncio.current_task()
+            for task in self.tasks:
+                if task is not current:
+                    task.cancel()
 
-            percent = int(100 * len(self.work_done) / self.torrent.piece_count)
-            human = Client._human_friendly_bytes_str(len(self.work_done) * self.torrent.piece_size)
-            logging.info(f'Progress: {len(self.work_done)}/{self.torrent.piece_count} ({percent}%) {human}')
+        percent = int(100 * len(self.work_done) / self.torrent.piece_count)
+        human = Client._human_friendly_bytes_str(len(self.work_done) * self.torrent.piece_size)
+        logging.info(f'Progress: {len(self.work_done)}/{self.torrent.piece_count} ({percent}%) {human}')
 
-            filepath = os.path.join(self.tmp, piece.sha1.hex())
-            with open(filepath, 'wb') as file:
-                file.write(data)
+        filepath = os.path.join(self.tmp, piece.sha1.hex())
+        with open(filepath, 'wb') as file:
+            file.write(data)
 
 
     def _has_finished(self) -> bool:
@@ -147,7 +180,7 @@ class Client:
             if piece.sha1.hex() in parts_downloaded:
                 self.work_done.add(piece)
             else:
-                self.work_queue.add(piece)
+                self.work_queue.set_piece(piece.index)
 
 
     def _assemble_files(self, output_directory: str):
@@ -169,16 +202,31 @@ class Client:
         written = 0
         with open(output, 'wb') as f:
             for piece in self.torrent.pieces[start_index:]:
+                if written == file.size:
+                    return
+                offset = start_offset if piece.index == start_index else 0
+                count = min(piece.size - offset, file.size - written)
                 part_path = os.path.join(self.tmp, piece.sha1.hex())
                 with open(part_path, 'rb') as part:
-                    data = part.read()
-                    if piece.index == start_index:
-                        written += f.write(data[start_offset:])
-                    else:
-                        rest = min(piece_size, file.size - written)
-                        written += f.write(data[:rest])
-                        if rest < piece_size:
-                            return
+                    written += Client._copy_range(part, f, offset, count)
+
+
+    @staticmethod
+    def _copy_range(src: BinaryIO, dst: BinaryIO, offset: int, count: int) -> int:
+        if not _USE_SENDFILE:
+            src.seek(offset)
+            copied = dst.write(src.read(count))
+        else:
+            copied = 0
+            while copied < count:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset + copied, count - copied)
+                if sent == 0:
+                    break
+                copied += sent
+
+        if copied != count:
+            raise OSError(f'Expected {count} bytes from {src.name}, copied {copied}')
+        return copied
 
 
     @staticmethod
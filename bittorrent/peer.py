@@ -1,21 +1,34 @@
-import time
 import socket
+import asyncio
 import struct
-import select
 import hashlib
 import logging
-from typing import Optional, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Awaitable, Iterator
 from dataclasses import dataclass, field
 from bittorrent.ip import IpAndPort
 from bittorrent.torrent import Piece
 
 
+_UINT32 = struct.Struct('!I')
+_MESSAGE_HEADER = struct.Struct('!IB')
+_PIECE_HEADER = struct.Struct('!II')
+_REQUEST_MESSAGE = struct.Struct('!IBIII')
+_HANDSHAKE = struct.Struct('!B19sQ20s20s')
+_PROTOCOL = b'BitTorrent protocol'
+_IOV_MAX = 1024
+_HASH_BATCH_SIZE = 2 ** 18
+# piece buffers kept for reuse, beyond that finished downloads free theirs
+_MAX_POOLED_BUFFERS = 8
+_BYTE_BITS = [tuple(r for r in range(8) if byte & (0x80 >> r)) for byte in range(256)]
+
+
 @dataclass
 class Cancelable:
     cancel: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class PeerMessage:
     KEEP_ALIVE = -1
     CHOKE = 0
@@ -32,75 +45,140 @@ class PeerMessage:
     payload: bytes = b''
 
 
-    def write(self, sock: socket.socket):
-        data = self.message_id.to_bytes(1, 'big') + self.payload
-        data = len(data).to_bytes(4, 'big') + data
-        PeerMessage.write_bytes(sock, data)
+    async def write(self, sock: socket.socket):
+        await PeerMessage.write_bytes(sock, *self.buffers())
 
 
-    @classmethod
-    def read(cls, sock: socket.socket, cancelable: Optional[Cancelable] = None) -> 'PeerMessage':
-        message_size_bytes = PeerMessage.read_bytes(sock, 4, cancelable)
-        message_size = int.from_bytes(message_size_bytes, 'big')
-        if message_size == 0:
-            return PeerMessage(PeerMessage.KEEP_ALIVE)
-        data = PeerMessage.read_bytes(sock, message_size, cancelable)
-        return PeerMessage(data[0], data[1:])
+    def buffers(self) -> tuple[bytes, bytes]:
+        return _MESSAGE_HEADER.pack(1 + len(self.payload), self.message_id), self.payload
 
 
     @staticmethod
-    def read_bytes(sock: socket.socket, size: int, cancelable: Optional[Cancelable] = None) -> bytes:
-        data = bytearray()
-        while len(data) != size:
-            if not PeerMessage._has_data(sock):
-                continue
-            if cancelable and cancelable.cancel:
-                return b''
-            length = size - len(data)
-            tmp = sock.recv(length)
-            if tmp == b'':
-                raise RuntimeError('socket connection broken')
-            data.extend(tmp)
-        return bytes(data)
+    async def write_all(sock: socket.socket, messages: list['PeerMessage']):
+        await PeerMessage.write_bytes(sock, *(buffer for message in messages for buffer in message.buffers()))
 
 
-    @staticmethod
-    def write_bytes(sock: socket.socket, data: bytes):
-        sock.sendall(data)
+    @classmethod
+    async def read(cls, reader: 'SocketReader') -> 'PeerMessage':
+        message_id, payload_size = await PeerMessage.read_header(reader)
+        return PeerMessage(message_id, await reader.read(payload_size))
 
 
     @staticmethod
-    def _has_data(sock: socket.socket) -> bool:
-        r, _, _ = select.select([sock], [], [])
-        return len(r) > 0
+    async def read_header(reader: 'SocketReader') -> tuple[int, int]:
+        message_size, = _UINT32.unpack(await reader.read(_UINT32.size))
+        if message_size == 0:
+            return PeerMessage.KEEP_ALIVE, 0
+        message_id, = await reader.read(1)
+        return message_id, message_size - 1
 
 
-@dataclass
+    @staticmethod
+    async def write_bytes(sock: socket.socket, *buffers: bytes):
+        # try a single non-blocking scatter-gather write first, the event loop
+        # has no sendmsg so whatever the kernel did not take is joined and
+        # handed to sock_sendall
+        views = [memoryview(buffer) for buffer in buffers if buffer]
+        try:
+            sent = sock.sendmsg(views[:_IOV_MAX])
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views:
+            views[0] = views[0][sent:]
+            await asyncio.get_running_loop().sock_sendall(sock, b''.join(views))
+
+
+class SocketReader:
+    def __init__(self, sock: socket.socket, timeout: float, buffer_size: int = 2 ** 16):
+        self.sock = sock
+        self.timeout = timeout
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+
+    async def read(self, size: int) -> bytes:
+        if size > len(self.buffer):
+            data = bytearray(size)
+            await self.read_into(memoryview(data))
+            return bytes(data)
+
+        while self.end - self.start < size:
+            await self._fill()
+        data = bytes(self.view[self.start:self.start + size])
+        self.start += size
+        return data
+
+
+    async def read_into(self, view: memoryview):
+        length = min(len(view), self.end - self.start)
+        view[:length] = self.view[self.start:self.start + length]
+        self.start += length
+        while length < len(view):
+            length += await self._recv_into(view[length:])
+
+
+    async def skip(self, size: int):
+        while size:
+            if self.start == self.end:
+                await self._fill()
+            length = min(size, self.end - self.start)
+            self.start += length
+            size -= length
+
+
+    async def _fill(self):
+        # keep the partial message at the front and receive behind it, so a
+        # single recv can complete it and queue up the following messages
+        if self.start:
+            self.buffer[:self.end - self.start] = self.buffer[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        self.end += await self._recv_into(self.view[self.end:])
+
+
+    async def _recv_into(self, view: memoryview) -> int:
+        async with asyncio.timeout(self.timeout):
+            received = await asyncio.get_running_loop().sock_recv_into(self.sock, view)
+        if received == 0:
+            raise ConnectionError('socket connection broken')
+        return received
+
+
+@dataclass(slots=True)
 class Bitfield:
     value: bytearray = field(default_factory=bytearray)
 
 
     def set_piece(self, index: int):
-        q = index // 8
-        r = index % 8
-        if q >= len(self.value):
-            diff = q - len(self.value) + 1
-            self.value.extend(bytes(diff))
-
-        byte = self.value[q]
-        mask = 1 << (7 - r)
-        self.value[q] = byte ^ mask
+        self.value[index >> 3] |= 0x80 >> (index & 7)
 
 
     def has_piece(self, index: int) -> bool:
-        q = index // 8
-        r = index % 8
-        if q >= len(self.value):
-            return False
+        q = index >> 3
+        return q < len(self.value) and self.value[q] & (0x80 >> (index & 7)) != 0
+
+
+    def clear_piece(self, index: int):
+        q = index >> 3
+        if q < len(self.value):
+            self.value[q] &= ~(0x80 >> (index & 7)) & 0xff
+
+
+    def pieces(self) -> Iterator[int]:
+        for q, byte in enumerate(self.value):
+            if byte:
+                for r in _BYTE_BITS[byte]:
+                    yield (q << 3) | r
+
 
-        byte = self.value[q]
-        mask = 1 << (7 - r)
-        return mask & byte > 0
+    def __and__(self, other: 'Bitfield') -> 'Bitfield':
+        size = min(len(self.value), len(other.value))
+        value = int.from_bytes(self.value[:size], 'big') & int.from_bytes(other.value[:size], 'big')
+        return Bitfield(bytearray(value.to_bytes(size, 'big')))
 
 
     @property
@@ -108,16 +186,26 @@ class Bitfield:
         return len(self.value)
 
 
+def make_handshake(info_hash: bytes, peer_id: bytes) -> bytes:
+    return _HANDSHAKE.pack(len(_PROTOCOL), _PROTOCOL, 0, info_hash, peer_id)
+
+
 class Peer:
+    # piece buffers released by finished downloads, reused by the next ones
+    _buffers: list[bytearray] = list()
+    # hashlib releases the GIL on large updates, so hashing there runs in
+    # parallel with the event loop serving the other peers
+    _hash_pool = ThreadPoolExecutor(max_workers=2)
+
+
     def __init__(
         self,
         peer: IpAndPort,
-        get_work: Callable[['Peer', Bitfield], Optional[Piece]],
+        get_work: Callable[['Peer', Optional[Bitfield]], Awaitable[Optional[Piece]]],
         put_work: Callable[['Peer', Piece], None],
-        put_result: Callable[['Peer', Piece, bytes], None],
+        put_result: Callable[['Peer', Piece, memoryview], None],
         has_finished: Callable[[], bool],
-        info_hash: bytes,
-        peer_id: bytes,
+        handshake: bytes,
         piece_count: int,
         chunk_size: int,
         max_batch_requests: int
@@ -127,99 +215,194 @@ class Peer:
         self.put_work = put_work
         self.put_result = put_result
         self.has_finished = has_finished
-        self.info_hash = info_hash
-        self.peer_id = peer_id
+        self.handshake = handshake
         self.piece_count = piece_count
         self.chunk_size = chunk_size
         self.max_batch_requests = max_batch_requests
-        self.bitfield = Bitfield()
+        self.bitfield = Bitfield(bytearray((piece_count + 7) // 8))
+        # until the peer sends BITFIELD or HAVE it is assumed to have every piece
+        self.bitfield_received = False
         self.cancelable = Cancelable()
         self.choked = True
+        self.requests = bytearray(_REQUEST_MESSAGE.size * max_batch_requests)
 
 
-    def start(self):
+    async def start(self):
         if self.has_finished():
             return
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(5)
-        if not self._connect_and_handshake():
-            self.sock.close()
-            return
-
-        self.sock.settimeout(30)
-        while not self.has_finished():
-            work = self.get_work(self, self.bitfield)
-            if not work:
-                logging.info('No work in queue')
-                time.sleep(5)
-                continue
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = SocketReader(
+            self.sock,
+            5,
+            4 * (_MESSAGE_HEADER.size + _PIECE_HEADER.size + self.chunk_size)
+        )
+        try:
+            if not await self._connect_and_handshake():
+                return
 
-            try:
-                self._download(work)
-            except socket.error as e:
-                logging.error('Socket error: %s', e)
-                self.put_work(self, work)
-                break
+            self.reader.timeout = 30
+            while not self.has_finished():
+                work = await self.get_work(self, self.bitfield if self.bitfield_received else None)
+                if not work:
+                    break
 
-        logging.debug('Shutdown peer...')
-        self.sock.close()
+                try:
+                    await self._download(work)
+                except (socket.error, struct.error) as e:
+                    logging.error('Socket error: %s', e)
+                    self.put_work(self, work)
+                    break
+        finally:
+            logging.debug('Shutdown peer...')
+            self.sock.close()
 
 
     def cancel_work(self):
         self.cancelable.cancel = True
 
 
-    def _connect_and_handshake(self) -> bool:
+    async def _connect_and_handshake(self) -> bool:
         try:
-            self.sock.connect((self.peer.ip, self.peer.port))
-            logging.debug(f'Connected to {self.peer.ip}:{self.peer.port}!')
-            if self._handshake():
-                logging.info(f'Handshake with {self.peer.ip}:{self.peer.port}!')
+            async with asyncio.timeout(self.reader.timeout):
+                await asyncio.get_running_loop().sock_connect(self.sock, (self.peer.ip, self.peer.port))
+            logging.debug('Connected to %s:%d!', self.peer.ip, self.peer.port)
+            if await self._handshake():
+                logging.info('Handshake with %s:%d!', self.peer.ip, self.peer.port)
                 return True
-            logging.error(f'Failed handshake with {self.peer.ip}:{self.peer.port}')
+            logging.error('Failed handshake with %s:%d', self.peer.ip, self.peer.port)
         except socket.error as e:
-            logging.error(f'Failed to connect to {self.peer.ip}:{self.peer.port}: %s', e)
+            logging.error('Failed to connect to %s:%d: %s', self.peer.ip, self.peer.port, e)
         return False
 
 
-    def _handshake(self) -> bool:
-        header = struct.pack('!b', 19) + b'BitTorrent protocol'
-        handshake = header + struct.pack('!Q20s20s', 0, self.info_hash, self.peer_id)
-        logging.debug('Sent handshake: %s', header + struct.pack('!Q20s20s', 0, self.info_hash, self.peer_id))
-        PeerMessage.write_bytes(self.sock, handshake)
-        data = PeerMessage.read_bytes(self.sock, len(header) + 48, self.cancelable)
-        if not data:
-            return False
-
-        _header, _, _info_hash, _ = struct.unpack('!20sQ20s20s', data)
+    async def _handshake(self) -> bool:
+        logging.debug('Sent handshake: %s', self.handshake)
+        await PeerMessage.write_bytes(self.sock, self.handshake)
+        data = await self.reader.read(_HANDSHAKE.size)
         logging.debug('Recv handshake: %s', data)
-        return (
-            _header == header and
-            _info_hash == self.info_hash
-        )
+        # length and protocol occupy the first 20 bytes, info_hash bytes 28 to 48
+        return data[:20] == self.handshake[:20] and data[28:48] == self.handshake[28:48]
+
+
+    async def _download(self, work: Piece):
+        buffer = Peer._buffers.pop() if Peer._buffers else bytearray()
+        if len(buffer) < work.size:
+            buffer = bytearray(work.size)
+        try:
+            await self._download_piece(work, memoryview(buffer)[:work.size])
+        finally:
+            if len(Peer._buffers) < _MAX_POOLED_BUFFERS:
+                Peer._buffers.append(buffer)
 
 
-    def _download(self, work: Piece):
-        downloaded_data = bytearray(work.size)
+    async def _download_piece(self, work: Piece, downloaded_view: memoryview):
         downloaded_bytes = 0
-        should_request_chunks = True
-        requests_received = 0
+        # received_bytes is the contiguous prefix received so far, chunks
+        # that arrived ahead of it wait in unhashed (start -> size); the
+        # prefix is hashed off the event loop in batches of _HASH_BATCH_SIZE
+        hasher = hashlib.sha1(usedforsecurity=False)
+        hashed_bytes = 0
+        received_bytes = 0
+        unhashed: dict[int, int] = dict()
+        # up to max_batch_requests REQUESTs are kept in flight, each PIECE
+        # received frees a slot that is refilled right away
+        requested_bytes = 0
+        in_flight = 0
         self.cancelable.cancel = False
 
+        if self.bitfield_received and not self.bitfield.has_piece(work.index):
+            logging.warning('Peer does not have data')
+            self.put_work(self, work)
+            return
+
         logging.debug('Start download...')
-        PeerMessage(PeerMessage.UNCHOKE).write(self.sock)
-        PeerMessage(PeerMessage.INTERESTED).write(self.sock)
+        await PeerMessage.write_all(self.sock, [
+            PeerMessage(PeerMessage.UNCHOKE),
+            PeerMessage(PeerMessage.INTERESTED)
+        ])
 
         while True:
-            message = PeerMessage.read(self.sock, self.cancelable)
+            if self.cancelable.cancel:
+                return
+
+            if not self.choked:
+                offset = 0
+                while in_flight < self.max_batch_requests and requested_bytes < work.size:
+                    length = min(self.chunk_size, work.size - requested_bytes)
+                    if requested_bytes not in unhashed:
+                        _REQUEST_MESSAGE.pack_into(
+                            self.requests,
+                            offset,
+                            _REQUEST_MESSAGE.size - _UINT32.size,
+                            PeerMessage.REQUEST,
+                            work.index,
+                            requested_bytes,
+                            length
+                        )
+                        offset += _REQUEST_MESSAGE.size
+                        in_flight += 1
+                    requested_bytes += length
+
+                if offset:
+                    logging.debug('Sending request to %s for piece #%d...', self.peer.ip, work.index)
+                    await PeerMessage.write_bytes(self.sock, memoryview(self.requests)[:offset])
+
+            # PIECE is by far the most frequent message, it is handled first
+            # without a PeerMessage and its payload is received straight
+            # into downloaded_view
+            message_id, size = await PeerMessage.read_header(self.reader)
+            if message_id == PeerMessage.PIECE:
+                index, start = _PIECE_HEADER.unpack(await self.reader.read(_PIECE_HEADER.size))
+                size -= _PIECE_HEADER.size
+                if index != work.index or start + size > work.size:
+                    logging.debug('Dropping chunk of piece #%d at %d', index, start)
+                    await self.reader.skip(size)
+                elif start < received_bytes or start in unhashed:
+                    logging.debug('Dropping duplicate chunk of piece #%d at %d', index, start)
+                    await self.reader.skip(size)
+                    in_flight = max(in_flight - 1, 0)
+                else:
+                    await self.reader.read_into(downloaded_view[start : start + size])
+                    in_flight = max(in_flight - 1, 0)
+                    downloaded_bytes += size
+                    unhashed[start] = size
+                    while received_bytes in unhashed:
+                        received_bytes += unhashed.pop(received_bytes)
+                    if received_bytes - hashed_bytes >= _HASH_BATCH_SIZE or received_bytes == work.size:
+                        await asyncio.get_running_loop().run_in_executor(
+                            Peer._hash_pool,
+                            hasher.update,
+                            downloaded_view[hashed_bytes:received_bytes]
+                        )
+                        hashed_bytes = received_bytes
+                    if logging.root.isEnabledFor(logging.DEBUG):
+                        progress = int(100 * downloaded_bytes / work.size)
+                        logging.debug('Piece #%d: %d/%d bytes downloaded (%d%%).', work.index, downloaded_bytes, work.size, progress)
+
+                    if hashed_bytes == work.size:
+                        if hasher.digest() == work.sha1:
+                            self.put_result(self, work, downloaded_view)
+                            await PeerMessage(PeerMessage.HAVE, _UINT32.pack(work.index)).write(self.sock)
+                            return
+                        else:
+                            logging.warning('Piece corrupted!')
+                            self.put_work(self, work)
+                            return
+                continue
 
+            message = PeerMessage(message_id, await self.reader.read(size))
             if message.message_id == PeerMessage.KEEP_ALIVE:
-                time.sleep(3)
+                logging.debug('_KEEP_ALIVE')
 
             elif message.message_id == PeerMessage.CHOKE:
                 logging.debug('Choked!')
                 self.choked = True
+                # a choking peer discards our outstanding requests
+                requested_bytes = received_bytes
+                in_flight = 0
 
             elif message.message_id == PeerMessage.UNCHOKE:
                 logging.debug('Unchoked!')
@@ -233,62 +416,23 @@ class Peer:
 
             elif message.message_id == PeerMessage.HAVE:
                 logging.debug('_HAVE')
-                index = int.from_bytes(message.payload, 'big')
-                self.bitfield.set_piece(index)
+                index, = _UINT32.unpack(message.payload)
+                if index < self.piece_count:
+                    self.bitfield.set_piece(index)
+                    self.bitfield_received = True
 
             elif message.message_id == PeerMessage.BITFIELD:
                 logging.debug('_BITFIELD')
-                self.bitfield.value = bytearray(message.payload)
+                size = self.bitfield.size
+                self.bitfield.value[:] = message.payload[:size].ljust(size, b'\x00')
+                self.bitfield_received = True
                 if not self.bitfield.has_piece(work.index):
-                    logging.warning(f'Peer does not have data')
+                    logging.warning('Peer does not have data')
                     self.put_work(self, work)
                     return
 
             elif message.message_id == PeerMessage.REQUEST:
                 logging.debug('_REQUEST')
 
-            elif message.message_id == PeerMessage.PIECE:
-                index = int.from_bytes(message.payload[0:4], 'big')
-                start = int.from_bytes(message.payload[4:8], 'big')
-                data = message.payload[8:]
-                downloaded_data[start : start + len(data)] = data
-                downloaded_bytes += len(data)
-                progress = int(100 * downloaded_bytes / work.size)
-                requests_received += 1
-                if requests_received == self.max_batch_requests:
-                    should_request_chunks = True
-
-                logging.debug(f'Piece #{work.index}: {downloaded_bytes}/{work.size} bytes downloaded ({progress}%).')
-
-                if downloaded_bytes == work.size:
-                    if self._sha1(downloaded_data) == work.sha1:
-                        self.put_result(self, work, downloaded_data)
-                        PeerMessage(PeerMessage.HAVE, work.index.to_bytes(4, 'big')).write(self.sock)
-                        return
-                    else:
-                        logging.warning('Piece corrupted!')
-                        self.put_work(self, work)
-                        return
-
             elif message.message_id == PeerMessage.CANCEL:
                 logging.debug('_CANCEL')
-
-            if self.cancelable.cancel:
-                return
-
-            if should_request_chunks and not self.choked:
-                logging.debug(f'Sending request to {self.peer.ip} for piece #{work.index}...')
-                should_request_chunks = False
-                requests_received = 0
-                tmp = downloaded_bytes
-                for _ in range(self.max_batch_requests):
-                    length = min(self.chunk_size, work.size - tmp)
-                    payload = struct.pack('!III', work.index, tmp, length)
-                    PeerMessage(PeerMessage.REQUEST, payload).write(self.sock)
-                    tmp += length
-
-
-    def _sha1(self, data: bytes) -> bytes:
-        hasher = hashlib.sha1()
-        hasher.update(data)
-        return hasher.digest()
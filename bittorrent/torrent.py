@@ -1,32 +1,9 @@
 import hashlib
 from urllib.parse import urlparse
 from dataclasses import dataclass, field
-from dataclasses_json import DataClassJsonMixin, config
 from typing import Optional
 from bittorrent.ip import IpAndPort
-from bittorrent.bencode import bencode, decode_bencode
-
-
-@dataclass
-class InfoFile(DataClassJsonMixin):
-    path: list[bytes]
-    length: int
-
-
-@dataclass
-class Info(DataClassJsonMixin):
-    name: bytes
-    pieces: bytes
-    piece_length: int = field(metadata=config(field_name='piece length'))
-    length: Optional[int] = None
-    files: Optional[list[InfoFile]] = None
-
-
-@dataclass
-class MetaInfo(DataClassJsonMixin):
-    trackers: Optional[bytes] = field(metadata=config(field_name='announce'))
-    trackers_list: Optional[list[list[bytes]]] = field(metadata=config(field_name='announce-list'))
-    info: Info
+from bittorrent.bencode import decode_bencode_spans
 
 
 @dataclass
@@ -45,7 +22,8 @@ class Piece:
 
 
     def __hash__(self) -> int:
-        return hash((self.index, self.size, self.sha1))
+        # the index alone identifies a piece within a torrent
+        return self.index
 
 
 @dataclass
@@ -58,17 +36,25 @@ class Torrent:
     trackers: list[str]
     files: list[File]
     pieces: list[Piece]
+    # (scheme, endpoint) of every tracker url with a port, parsed once
+    _tracker_endpoints: list[tuple[str, IpAndPort]] = field(init=False, repr=False, compare=False)
 
 
-    def trackers_by_protocol(self, protocol: Optional[str] = None) -> list[IpAndPort]:
-        result: list[tuple[str, int]] = []
+    def __post_init__(self):
+        self._tracker_endpoints = list()
         for url in self.trackers:
             res = urlparse(url)
-            if not res.port:
-                continue
-            if not protocol or protocol.lower() == res.scheme.lower():
-                result.append(IpAndPort(res.hostname, res.port))
-        return result
+            if res.port:
+                self._tracker_endpoints.append((res.scheme.lower(), IpAndPort(res.hostname, res.port)))
+
+
+    def trackers_by_protocol(self, protocol: Optional[str] = None) -> list[IpAndPort]:
+        scheme = protocol.lower() if protocol else None
+        return [
+            endpoint
+            for endpoint_scheme, endpoint in self._tracker_endpoints
+            if not scheme or scheme == endpoint_scheme
+        ]
 
 
     @classmethod
@@ -79,49 +65,53 @@ class Torrent:
 
     @classmethod
     def from_bytes(cls, data: bytes) -> 'Torrent':
-        decoded = decode_bencode(data)
-        metainfo = MetaInfo.from_dict(decoded)
-        info_hash = Torrent.sha1(bencode(decoded['info']))
-        file_size = metainfo.info.length or sum([file.length for file in metainfo.info.files])
-        piece_count = len(metainfo.info.pieces) // 20
+        decoded, spans = decode_bencode_spans(data)
+        info = decoded['info']
+        # hash the info dict exactly as it appears in the file
+        info_start, info_end = spans['info']
+        info_hash = Torrent.sha1(memoryview(data)[info_start:info_end])
+        name: bytes = info['name']
+        hashes: bytes = info['pieces']
+        piece_length: int = info['piece length']
+        length: Optional[int] = info.get('length')
+        file_size = length or sum([file['length'] for file in info['files']])
+        if len(hashes) % 20 != 0:
+            raise ValueError('Pieces should be a concatenation of 20-byte SHA1 hashes.')
+        piece_count = len(hashes) // 20
 
         # trackers
         trackers: list[str] = list()
-        if metainfo.trackers:
-            trackers.append(metainfo.trackers.decode())
-        if metainfo.trackers_list:
-            for tier in metainfo.trackers_list:
+        if decoded.get('announce'):
+            trackers.append(decoded['announce'].decode())
+        if decoded.get('announce-list'):
+            for tier in decoded['announce-list']:
                 for url in tier:
                     trackers.append(url.decode())
 
         # files
         files: list[File] = list()
-        if metainfo.info.length:
-            files.append(File(0, 0, metainfo.info.length, [metainfo.info.name.decode()]))
+        if length:
+            files.append(File(0, 0, length, [name.decode()]))
         else:
             start = 0
-            for index, file in enumerate(metainfo.info.files):
-                paths = [path.decode() for path in file.path]
-                files.append(File(index, start, file.length, paths))
-                start += file.length
+            for index, file in enumerate(info['files']):
+                paths = [path.decode() for path in file['path']]
+                files.append(File(index, start, file['length'], paths))
+                start += file['length']
 
         # pieces
-        hashes = [
-            metainfo.info.pieces[i : i + 20]
-            for i in range(0, len(metainfo.info.pieces), 20)
-        ]
         pieces: list[Piece] = list()
         for i in range(piece_count):
             if i < piece_count - 1:
-                piece_size = metainfo.info.piece_length
+                piece_size = piece_length
             else:
-                piece_size = file_size - metainfo.info.piece_length * (piece_count - 1)
-            pieces.append(Piece(i, piece_size, hashes[i]))
-    
+                piece_size = file_size - piece_length * (piece_count - 1)
+            pieces.append(Piece(i, piece_size, hashes[i * 20 : i * 20 + 20]))
+
         return Torrent(
-            metainfo.info.name.decode(),
+            name.decode(),
             file_size,
-            metainfo.info.piece_length,
+            piece_length,
             piece_count,
             info_hash,
             trackers,
@@ -132,6 +122,4 @@ class Torrent:
 
     @staticmethod
     def sha1(data: bytes) -> bytes:
-        hasher = hashlib.sha1()
-        hasher.update(data)
-        return hasher.digest()
+        return hashlib.sha1(data, usedforsecurity=False).digest()
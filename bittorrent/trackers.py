@@ -1,18 +1,35 @@
 import socket
 import struct
 import random
+import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from dataclasses import dataclass
 from bittorrent.ip import IpAndPort
 from bittorrent.torrent import Torrent
 
+# action of the reply a tracker sends instead of the expected one on failure
+_ERROR_ACTION = 3
+_ACTION = struct.Struct('!I')
+
+
+def _check_action(data: bytes, expected: int):
+    # Offset  Size            Name            Value
+    # 0       32-bit integer  action          3 // error
+    # 4       32-bit integer  transaction_id
+    # 8       string          message
+    action, = _ACTION.unpack_from(data)
+    if action == _ERROR_ACTION:
+        raise ValueError(f'Tracker error: {data[8:].decode(errors="replace")}')
+    if action != expected:
+        raise ValueError(f'Tracker replied with action {action}, expected {expected}')
+
 
 @dataclass
 class _ConnectRequest:
     _PROTOCOL_ID = 0x41727101980
     _ACTION = 0
+    _STRUCT = struct.Struct('!QII')
 
     transaction_id: int
 
@@ -21,8 +38,7 @@ class _ConnectRequest:
         # 0       64-bit integer  protocol_id     0x41727101980 // magic constant
         # 8       32-bit integer  action          0 // connect
         # 12      32-bit integer  transaction_id
-        return struct.pack(
-            '!QII',
+        return _ConnectRequest._STRUCT.pack(
             _ConnectRequest._PROTOCOL_ID,
             _ConnectRequest._ACTION,
             self.transaction_id
@@ -31,6 +47,8 @@ class _ConnectRequest:
 
 @dataclass
 class _ConnectResponse:
+    _STRUCT = struct.Struct('!IIQ')
+
     transaction_id: int
     connection_id: int
 
@@ -41,22 +59,18 @@ class _ConnectResponse:
         # 0       32-bit integer  action          0 // connect
         # 4       32-bit integer  transaction_id
         # 8       64-bit integer  connection_id
-        action, transaction_id, connection_id = struct.unpack('!IIQ', data)
-        assert action == _ConnectRequest._ACTION
+        _check_action(data, _ConnectRequest._ACTION)
+        _, transaction_id, connection_id = _ConnectResponse._STRUCT.unpack_from(data)
         return _ConnectResponse(transaction_id, connection_id)
 
 
-    @staticmethod
-    def size() -> int:
-        return 16
-
-
 @dataclass
 class _AnnounceRequest:
     _ACTION = 1
     EVENT_COMPLETE = 1
     EVENT_START = 2
     EVENT_STOP = 3
+    _STRUCT = struct.Struct('!QII20s20sQQQIIIiH')
 
     connection_id: int
     transaction_id: int
@@ -87,8 +101,7 @@ class _AnnounceRequest:
         # 88      32-bit integer  key
         # 92      32-bit integer  num_want        -1 // default
         # 96      16-bit integer  port
-        return struct.pack(
-            '!QII20s20sQQQIIIiH',
+        return _AnnounceRequest._STRUCT.pack(
             self.connection_id,
             _AnnounceRequest._ACTION,
             self.transaction_id,
@@ -107,11 +120,15 @@ class _AnnounceRequest:
 
 @dataclass
 class _AnnounceResponse:
+    _STRUCT = struct.Struct('!IIIII')
+    _PEER_STRUCT = struct.Struct('!IH')
+
     transaction_id: int
     interval: int
     leechers: int
     seeders: int
-    peers: list[IpAndPort]
+    # packed (ip << 16) | port keys, see _peer_address
+    peers: list[int]
 
 
     @classmethod
@@ -124,37 +141,69 @@ class _AnnounceResponse:
         # 16          32-bit integer  seeders
         # 20 + 6 * n  32-bit integer  IP address
         # 24 + 6 * n  16-bit integer  TCP port
-        if len(data) < 20 or (len(data) - 20) % 6 != 0:
+        _check_action(data, _AnnounceRequest._ACTION)
+        header_size = _AnnounceResponse._STRUCT.size
+        if len(data) < header_size or (len(data) - header_size) % _AnnounceResponse._PEER_STRUCT.size != 0:
             return _AnnounceResponse(0, 0, 0, 0, [])
 
-        peers_count = (len(data) - 20) // 6
-        (
-            action,
-            transaction_id,
-            interval,
-            leechers,
-            seeders,
-            *ips_and_ports
-        ) = struct.unpack('!IIIII' + peers_count * 'IH', data)
-        assert action == _AnnounceRequest._ACTION
+        _, transaction_id, interval, leechers, seeders = _AnnounceResponse._STRUCT.unpack_from(data)
         peers = [
-            IpAndPort(
-                _AnnounceResponse._parse_ip(ips_and_ports[i]),
-                ips_and_ports[i + 1]
-            )
-            for i in range(0, len(ips_and_ports), 2)
+            (ip << 16) | port
+            for ip, port in _AnnounceResponse._PEER_STRUCT.iter_unpack(memoryview(data)[header_size:])
         ]
         return _AnnounceResponse(transaction_id, interval, leechers, seeders, peers)
 
 
     @staticmethod
-    def _parse_ip(ip: int) -> str:
-        return socket.inet_ntoa(struct.pack('!L', ip))
+    def size(peers: int) -> int:
+        return _AnnounceResponse._STRUCT.size + _AnnounceResponse._PEER_STRUCT.size * peers
 
 
-    @staticmethod
-    def size(peers: int) -> int:
-        return 20 + 6 * peers
+class _TrackerProtocol(asyncio.DatagramProtocol):
+    # every announce shares one socket, replies are routed back to the
+    # pending exchange by the transaction id at offset 4
+    _TRANSACTION_ID = struct.Struct('!I')
+
+    def __init__(self):
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.pending: dict[int, asyncio.Future[bytes]] = dict()
+
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        if len(data) < 8:
+            return
+        transaction_id, = _TrackerProtocol._TRANSACTION_ID.unpack_from(data, 4)
+        future = self.pending.get(transaction_id)
+        if future and not future.done():
+            future.set_result(data)
+
+
+    def error_received(self, exc: OSError):
+        # on an unconnected socket ICMP errors can't be tied to an exchange,
+        # the affected announce simply times out
+        logging.debug('Tracker socket error: %s', exc)
+
+
+    def transaction_id(self) -> int:
+        while True:
+            transaction_id = int.from_bytes(random.randbytes(4), 'big')
+            if transaction_id not in self.pending:
+                return transaction_id
+
+
+    async def exchange(self, request: bytes, addr: tuple[str, int], transaction_id: int, timeout: float) -> bytes:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction_id] = future
+        try:
+            self.transport.sendto(request, addr)
+            async with asyncio.timeout(timeout):
+                return await future
+        finally:
+            del self.pending[transaction_id]
 
 
 class Trackers:
@@ -171,47 +220,72 @@ class Trackers:
         self.max_peers_per_tracker = max_peers_per_tracker
 
 
-    def get_peers(self) -> set[IpAndPort]:
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            trackers = self.torrent.trackers_by_protocol('udp')
-            return {
-                peer
-                for peers in executor.map(self._get_peers_from_tracker, trackers)
-                for peer in peers
-            }
+    async def get_peers(self) -> set[IpAndPort]:
+        # all trackers are announced to concurrently from the event loop,
+        # max_workers bounds how many exchanges are in flight at once
+        semaphore = asyncio.Semaphore(self.max_workers)
+        trackers = self.torrent.trackers_by_protocol('udp')
+        transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            _TrackerProtocol,
+            local_addr=('0.0.0.0', 0),
+            family=socket.AF_INET
+        )
+        try:
+            results = await asyncio.gather(*[
+                self._get_peers_from_tracker(protocol, tracker, semaphore)
+                for tracker in trackers
+            ])
+        finally:
+            transport.close()
+        # peers are deduplicated as packed ints, IpAndPort is only built once per peer
+        return {Trackers._peer_address(peer) for peer in set().union(*results)}
 
 
-    def _get_peers_from_tracker(self, tracker: IpAndPort) -> set[IpAndPort]:
-        response = self._announce(tracker, _AnnounceRequest.EVENT_START)
-        if not response:
-            logging.error(f'Failed to announce START to tracker {tracker.ip}:{tracker.port}')
-            return {}
+    async def _get_peers_from_tracker(
+        self,
+        protocol: _TrackerProtocol,
+        tracker: IpAndPort,
+        semaphore: asyncio.Semaphore
+    ) -> set[int]:
+        async with semaphore:
+            response = await self._announce(protocol, tracker, _AnnounceRequest.EVENT_START)
+            if not response:
+                logging.error('Failed to announce START to tracker %s:%d', tracker.ip, tracker.port)
+                return set()
 
-        if not response:
-            return {}
+            if len(response.peers) == 0:
+                response = await self._announce(protocol, tracker, _AnnounceRequest.EVENT_STOP)
+                if not response:
+                    logging.error('Failed to announce STOP to tracker %s:%d', tracker.ip, tracker.port)
+                    return set()
 
-        if len(response.peers) == 0:
-            response = self._announce(tracker, _AnnounceRequest.EVENT_STOP)
-            if not response:
-                logging.error(f'Failed to announce STOP to tracker {tracker.ip}:{tracker.port}')
+        return {peer for peer in response.peers if peer & 0xffff != 0}
 
-        return {peer for peer in response.peers if peer.port != 0}
 
+    @staticmethod
+    def _peer_address(peer: int) -> IpAndPort:
+        return IpAndPort(socket.inet_ntoa((peer >> 16).to_bytes(4, 'big')), peer & 0xffff)
 
-    def _announce(self, tracker: IpAndPort, event: int) -> Optional[_AnnounceResponse]:
-        logging.debug(f'Announcing to {tracker.ip}:{tracker.port} ...')
 
-        transaction_id = int.from_bytes(random.randbytes(4), 'big')
+    async def _announce(self, protocol: _TrackerProtocol, tracker: IpAndPort, event: int) -> Optional[_AnnounceResponse]:
+        logging.debug('Announcing to %s:%d ...', tracker.ip, tracker.port)
 
-        # open socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(3)
+        transaction_id = protocol.transaction_id()
 
         try:
+            # resolve
+            addresses = await asyncio.get_running_loop().getaddrinfo(
+                tracker.ip,
+                tracker.port,
+                family=socket.AF_INET,
+                type=socket.SOCK_DGRAM
+            )
+            address = addresses[0][4]
+
             # connect
             connect_request = _ConnectRequest(transaction_id)
-            sock.sendto(connect_request.to_bytes(), (tracker.ip, tracker.port))
-            connect_response = _ConnectResponse.from_bytes(sock.recv(_ConnectResponse.size()))
+            data = await protocol.exchange(connect_request.to_bytes(), address, transaction_id, 3)
+            connect_response = _ConnectResponse.from_bytes(data)
             if transaction_id != connect_response.transaction_id:
                 logging.error('Tracker did not return the expected transaction id')
                 return None
@@ -226,16 +300,23 @@ class Trackers:
                 self.torrent.size, # left
                 event
             )
-            sock.sendto(announce_request.to_bytes(), (tracker.ip, tracker.port))
-            announce_response = _AnnounceResponse.from_bytes(sock.recv(_AnnounceResponse.size(self.max_peers_per_tracker)))
+            data = await protocol.exchange(announce_request.to_bytes(), address, transaction_id, 3)
+            announce_response = _AnnounceResponse.from_bytes(data[:_AnnounceResponse.size(self.max_peers_per_tracker)])
             if transaction_id != announce_response.transaction_id:
                 logging.error('Tracker did not return the expected transaction id')
                 return None
 
             logging.debug('Announced to tracker successfully!')
             return announce_response
+        except TimeoutError:
+            logging.error('Announce timed out')
+            return None
         except socket.error as e:
             logging.error('Announce failed: %s', e)
             return None
-        finally:
-            sock.close()
\ No newline at end of file
+        except struct.error as e:
+            logging.error('Tracker sent a truncated response: %s', e)
+            return None
+        except ValueError as e:
+            logging.error('Announce failed: %s', e)
+            return None
\ No newline at end of file
@@ -1,87 +1,162 @@
+import random
 import unittest
-from bittorrent.bencode import bencode, decode_bencode
+from bittorrent.bencode import bencode, decode_bencode, decode_bencode_spans, BDecoder
 
 
 class TestBencode(unittest.TestCase):
-    def test_string(self):
-        self.assertEqual(bencode(b'omar'), b'4:omar')
-
-    def test_empty_string(self):
-        self.assertEqual(bencode(b''), b'0:')
-
-    def test_int(self):
-        self.assertEqual(bencode(12345), b'i12345e')
-
-    def test_int_negative(self):
-        self.assertEqual(bencode(-12345), b'i-12345e')
-
-    def test_int_zero(self):
-        self.assertEqual(bencode(0), b'i0e')
-
-    def test_list(self):
-        self.assertEqual(bencode([1, 2, 3]), b'li1ei2ei3ee')
-
-    def test_list_empty(self):
-        self.assertEqual(bencode([]), b'le')
-
-    def test_list_multiple_types(self):
-        self.assertEqual(bencode([1, b'a', [2]]), b'li1e1:ali2eee')
-
-    def test_dict(self):
-        self.assertEqual(bencode({'a': b'omar'}), b'd1:a4:omare')
-
-    def test_dict_empty(self):
-        self.assertEqual(bencode({}), b'de')
-
-    def test_dict_multiple_types(self):
-        self.assertEqual(bencode({'a': 1, 'b': [1, {'c': 0}]}), b'd1:ai1e1:bli1ed1:ci0eeee')
+    CASES = [
+        ('string', b'omar', b'4:omar'),
+        ('empty_string', b'', b'0:'),
+        ('str_non_ascii', 'é', b'2:\xc3\xa9'),
+        ('int', 12345, b'i12345e'),
+        ('int_negative', -12345, b'i-12345e'),
+        ('int_zero', 0, b'i0e'),
+        ('list', [1, 2, 3], b'li1ei2ei3ee'),
+        ('list_empty', [], b'le'),
+        ('list_multiple_types', [1, b'a', [2]], b'li1e1:ali2eee'),
+        ('dict', {'a': b'omar'}, b'd1:a4:omare'),
+        ('dict_empty', {}, b'de'),
+        ('dict_multiple_types', {'a': 1, 'b': [1, {'c': 0}]}, b'd1:ai1e1:bli1ed1:ci0eeee'),
+        ('dict_sorted_keys', {'b': 1, 'a': 2}, b'd1:ai2e1:bi1ee'),
+        ('dict_str_and_bytes_keys', {'b': 1, b'a': 2}, b'd1:ai2e1:bi1ee'),
+    ]
+
+    ERRORS = [
+        ('dict_without_str_key', {1: 2}),
+        ('dict_mixed_keys', {1: 2, 'a': 3}),
+        ('float', 1.5),
+    ]
+
+    def test_cases(self):
+        for name, value, expected in self.CASES:
+            with self.subTest(name):
+                self.assertEqual(bencode(value), expected)
+
+    def test_errors(self):
+        for name, value in self.ERRORS:
+            with self.subTest(name):
+                self.assertRaises(ValueError, lambda: bencode(value))
 
 
 class TestDecodeBencode(unittest.TestCase):
-    def test_empty(self):
-        self.assertEqual(decode_bencode(b''), b'')
-
-    def test_string(self):
-        self.assertEqual(decode_bencode(b'4:omar'), b'omar')
-
-    def test_empty_string(self):
-        self.assertEqual(decode_bencode(b'0:'), b'')
-
-    def test_int(self):
-        self.assertEqual(decode_bencode(b'i12345e'), 12345)
-
-    def test_negative_int(self):
-        self.assertEqual(decode_bencode(b'i-12345e'), -12345)
-
-    def test_empty_int(self):
-        self.assertEqual(decode_bencode(b'ie'), 0)
-
-    def test_list(self):
-        self.assertEqual(decode_bencode(b'li1ei2ei3ee'), [1, 2, 3])
-
-    def test_empty_list(self):
-        self.assertEqual(decode_bencode(b'le'), [])
-
-    def test_list_multiple_types(self):
-        self.assertEqual(decode_bencode(b'li1ei2ei3e4:omarl1:a1:b0:ee'), [1, 2, 3, b'omar', [b'a', b'b', b'']])
-
-    def test_list_of_list(self):
-        self.assertEqual(decode_bencode(b'llee'), [[]])
-
-    def test_dict(self):
-        self.assertEqual(decode_bencode(b'd4:omari12345ee'), {'omar': 12345})
-
-    def test_empty_dict(self):
-        self.assertEqual(decode_bencode(b'de'), {})
-
-    def test_dict_multiple_types(self):
-        self.assertEqual(decode_bencode(b'd4:omari12345e1:ali1ei2eee'), {'omar': 12345, 'a': [1, 2]})
-
-    def test_dict_of_dict(self):
-        self.assertEqual(decode_bencode(b'd1:adee'), {'a': {}})
-
-    def test_dict_without_str_key(self):
-        self.assertRaises(ValueError, lambda: decode_bencode(b'di1ei2ee'))
+    CASES = [
+        ('empty', b'', b''),
+        ('string', b'4:omar', b'omar'),
+        ('empty_string', b'0:', b''),
+        ('int', b'i12345e', 12345),
+        ('negative_int', b'i-12345e', -12345),
+        ('empty_int', b'ie', 0),
+        ('list', b'li1ei2ei3ee', [1, 2, 3]),
+        ('empty_list', b'le', []),
+        ('list_multiple_types', b'li1ei2ei3e4:omarl1:a1:b0:ee', [1, 2, 3, b'omar', [b'a', b'b', b'']]),
+        ('list_of_list', b'llee', [[]]),
+        ('dict', b'd4:omari12345ee', {'omar': 12345}),
+        ('empty_dict', b'de', {}),
+        ('dict_multiple_types', b'd4:omari12345e1:ali1ei2eee', {'omar': 12345, 'a': [1, 2]}),
+        ('dict_of_dict', b'd1:adee', {'a': {}}),
+    ]
+
+    ERRORS = [
+        ('unterminated_int', b'li12'),
+        ('string_without_colon', b'l12'),
+        ('truncated_string', b'l5:abce'),
+        ('truncated_key', b'd5:abce'),
+        ('dict_without_str_key', b'di1ei2ee'),
+        ('dict_key_without_value', b'd1:ae'),
+        ('unknown_character', b'lxe'),
+        ('unterminated_list', b'l'),
+        ('trailing_data', b'i1ei2e'),
+    ]
+
+    def test_cases(self):
+        for name, data, expected in self.CASES:
+            with self.subTest(name):
+                self.assertEqual(decode_bencode(data), expected)
+
+    def test_errors(self):
+        for name, data in self.ERRORS:
+            with self.subTest(name):
+                self.assertRaises(ValueError, lambda: decode_bencode(data))
+
+    def test_deeply_nested_list(self):
+        value = decode_bencode(b'l' * 10000 + b'e' * 10000)
+        for _ in range(9999):
+            value = value[0]
+        self.assertEqual(value, [])
+
+
+class TestRoundTrip(unittest.TestCase):
+    @staticmethod
+    def _value(rng: random.Random, depth: int = 0):
+        kind = rng.randrange(4 if depth < 4 else 2)
+        if kind == 0:
+            return rng.choice([0, 1, -1, rng.randrange(256), rng.randrange(-2 ** 70, 2 ** 70)])
+        if kind == 1:
+            return rng.randbytes(rng.choice([0, 1, rng.randrange(300)]))
+        if kind == 2:
+            return [TestRoundTrip._value(rng, depth + 1) for _ in range(rng.randrange(5))]
+        return {
+            ''.join(chr(rng.randrange(1, 0xd800)) for _ in range(rng.randrange(8))): TestRoundTrip._value(rng, depth + 1)
+            for _ in range(rng.randrange(5))
+        }
+
+    def test_random_values(self):
+        rng = random.Random(0)
+        for i in range(500):
+            value = self._value(rng)
+            with self.subTest(i):
+                self.assertEqual(decode_bencode(bencode(value)), value)
+
+
+class TestBDecoder(unittest.TestCase):
+    DATA = b'd4:omari12345e0:li-1e0:ee4:spam' + b'le'
+
+    def test_single_feed(self):
+        self.assertEqual(BDecoder().feed(self.DATA), [{'omar': 12345, '': [-1, b'']}, b'spam', []])
+
+    def test_split_at_every_offset(self):
+        for split in range(len(self.DATA)):
+            with self.subTest(split):
+                decoder = BDecoder()
+                values = decoder.feed(self.DATA[:split]) + decoder.feed(self.DATA[split:])
+                self.assertEqual(values, [{'omar': 12345, '': [-1, b'']}, b'spam', []])
+
+    def test_byte_by_byte(self):
+        decoder = BDecoder()
+        values = [value for byte in self.DATA for value in decoder.feed(bytes([byte]))]
+        self.assertEqual(values, [{'omar': 12345, '': [-1, b'']}, b'spam', []])
+
+    def test_incomplete(self):
+        decoder = BDecoder()
+        self.assertEqual(decoder.feed(b'l10:abc'), [])
+        self.assertEqual(decoder.feed(b'defghij'), [])
+        self.assertEqual(decoder.feed(b'e'), [[b'abcdefghij']])
+
+    def test_error_resets(self):
+        decoder = BDecoder()
+        self.assertEqual(decoder.feed(b'l1:a'), [])
+        self.assertRaises(ValueError, lambda: decoder.feed(b'xe'))
+        self.assertEqual(decoder.feed(b'i1e'), [1])
+
+
+class TestDecodeBencodeSpans(unittest.TestCase):
+    def test_spans(self):
+        data = b'd1:ai1e4:infod1:b0:ee'
+        decoded, spans = decode_bencode_spans(data)
+        self.assertEqual(decoded, {'a': 1, 'info': {'b': b''}})
+        self.assertEqual(data[slice(*spans['a'])], b'i1e')
+        self.assertEqual(data[slice(*spans['info'])], b'd1:b0:e')
+
+    def test_not_dict(self):
+        self.assertRaises(ValueError, lambda: decode_bencode_spans(b'li1ee'))
+
+    def test_truncated(self):
+        for data in (b'd', b'd1:ai1e', b'd1:ai1'):
+            with self.subTest(data):
+                self.assertRaises(ValueError, lambda: decode_bencode_spans(data))
+
+    def test_trailing_data(self):
+        self.assertRaises(ValueError, lambda: decode_bencode_spans(b'de1'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+import socket
+import asyncio
+import unittest
+from bittorrent.ip import IpAndPort
+from bittorrent.torrent import Piece
+from bittorrent.peer import Bitfield, Peer, PeerMessage, SocketReader
+
+
+class TestBitfield(unittest.TestCase):
+    def test_has_piece(self):
+        bitfield = Bitfield(bytearray(b'\x80\x01'))
+        self.assertTrue(bitfield.has_piece(0))
+        self.assertFalse(bitfield.has_piece(1))
+        self.assertTrue(bitfield.has_piece(15))
+
+    def test_has_piece_out_of_range(self):
+        self.assertFalse(Bitfield(bytearray(b'\xff')).has_piece(8))
+
+    def test_set_piece(self):
+        bitfield = Bitfield(bytearray(2))
+        bitfield.set_piece(9)
+        self.assertEqual(bitfield.value, bytearray(b'\x00\x40'))
+
+    def test_set_piece_out_of_range(self):
+        with self.assertRaises(IndexError):
+            Bitfield(bytearray(1)).set_piece(8)
+
+    def test_set_piece_twice(self):
+        bitfield = Bitfield(bytearray(1))
+        bitfield.set_piece(3)
+        bitfield.set_piece(3)
+        self.assertTrue(bitfield.has_piece(3))
+
+    def test_clear_piece(self):
+        bitfield = Bitfield(bytearray(b'\xff'))
+        bitfield.clear_piece(0)
+        self.assertEqual(bitfield.value, bytearray(b'\x7f'))
+
+    def test_pieces(self):
+        self.assertEqual(list(Bitfield(bytearray(b'\x81\x00\x40')).pieces()), [0, 7, 17])
+
+    def test_and(self):
+        bitfield = Bitfield(bytearray(b'\xf0\x0f')) & Bitfield(bytearray(b'\x30'))
+        self.assertEqual(bitfield.value, bytearray(b'\x30'))
+
+
+class TestSocketReader(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.other = socket.socketpair()
+        self.sock.setblocking(False)
+        self.reader = SocketReader(self.sock, 1, 8)
+
+    def tearDown(self):
+        self.sock.close()
+        self.other.close()
+
+    def test_read_across_fills(self):
+        async def read():
+            return [await self.reader.read(3) for _ in range(4)]
+
+        self.other.sendall(b'abcdefghijkl')
+        self.assertEqual(asyncio.run(read()), [b'abc', b'def', b'ghi', b'jkl'])
+
+    def test_read_larger_than_buffer(self):
+        self.other.sendall(b'0123456789ab')
+        self.assertEqual(asyncio.run(self.reader.read(12)), b'0123456789ab')
+
+    def test_read_into(self):
+        data = bytearray(6)
+        self.other.sendall(b'xyz123')
+        asyncio.run(self.reader.read_into(memoryview(data)))
+        self.assertEqual(data, b'xyz123')
+
+    def test_skip(self):
+        async def skip_and_read():
+            await self.reader.skip(10)
+            return await self.reader.read(2)
+
+        self.other.sendall(b'0123456789ab')
+        self.assertEqual(asyncio.run(skip_and_read()), b'ab')
+
+    def test_closed(self):
+        self.other.close()
+        self.assertRaises(ConnectionError, asyncio.run, self.reader.read(1))
+
+
+class TestPeerMessage(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.other = socket.socketpair()
+        self.sock.setblocking(False)
+        self.other.setblocking(False)
+
+    def tearDown(self):
+        self.sock.close()
+        self.other.close()
+
+    def test_write_bytes_short_writes(self):
+        data = bytes(range(256)) * 4096
+
+        async def transfer():
+            loop = asyncio.get_running_loop()
+            received = bytearray()
+
+            async def receive():
+                while len(received) < len(data) + 3:
+                    received.extend(await loop.sock_recv(self.other, 2 ** 16))
+
+            await asyncio.gather(PeerMessage.write_bytes(self.sock, b'abc', data), receive())
+            return bytes(received)
+
+        self.assertEqual(asyncio.run(transfer()), b'abc' + data)
+
+    def test_read(self):
+        self.other.sendall(b'\x00\x00\x00\x05\x04\x00\x00\x00\x07\x00\x00\x00\x00')
+        reader = SocketReader(self.sock, 1)
+        self.assertEqual(asyncio.run(PeerMessage.read(reader)), PeerMessage(PeerMessage.HAVE, b'\x00\x00\x00\x07'))
+        self.assertEqual(asyncio.run(PeerMessage.read(reader)), PeerMessage(PeerMessage.KEEP_ALIVE))
+
+
+class TestPeer(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.other = socket.socketpair()
+        self.sock.setblocking(False)
+        self.other.setblocking(False)
+        self.returned: list[Piece] = list()
+        self.peer = Peer(
+            IpAndPort('127.0.0.1', 6881),
+            None,
+            lambda peer, work: self.returned.append(work),
+            None,
+            lambda: False,
+            b'',
+            16,
+            2 ** 14,
+            30
+        )
+        self.peer.sock = self.sock
+        self.peer.reader = SocketReader(self.sock, 1)
+
+    def tearDown(self):
+        self.sock.close()
+        self.other.close()
+
+    def test_download_piece_missing_from_bitfield(self):
+        self.peer.bitfield.set_piece(1)
+        self.peer.bitfield_received = True
+        work = Piece(0, 2 ** 14, bytes(20))
+        asyncio.run(self.peer._download(work))
+        self.assertEqual(self.returned, [work])
+        self.assertRaises(BlockingIOError, self.other.recv, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import socket
+import struct
+import asyncio
+import unittest
+from bittorrent.ip import IpAndPort
+from bittorrent.torrent import Torrent
+from bittorrent.trackers import Trackers, _ConnectResponse, _AnnounceResponse
+
+
+class _FakeTracker(asyncio.DatagramProtocol):
+    def __init__(self, error: bool):
+        self.error = error
+
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        _, action, transaction_id = struct.unpack_from('!QII', data)
+        if self.error:
+            self.transport.sendto(struct.pack('!II', 3, transaction_id) + b'torrent not registered', addr)
+        elif action == 0:
+            self.transport.sendto(struct.pack('!IIQ', 0, transaction_id, 7), addr)
+        else:
+            peer = socket.inet_aton('1.2.3.4') + struct.pack('!H', 6881)
+            self.transport.sendto(struct.pack('!IIIII', 1, transaction_id, 10, 0, 1) + peer, addr)
+
+
+class TestResponses(unittest.TestCase):
+    ERROR = struct.pack('!II', 3, 1) + b'torrent not registered'
+
+    def test_connect_error(self):
+        with self.assertRaisesRegex(ValueError, 'torrent not registered'):
+            _ConnectResponse.from_bytes(self.ERROR)
+
+    def test_announce_error(self):
+        with self.assertRaisesRegex(ValueError, 'torrent not registered'):
+            _AnnounceResponse.from_bytes(self.ERROR)
+
+    def test_unexpected_action(self):
+        self.assertRaises(ValueError, lambda: _ConnectResponse.from_bytes(struct.pack('!IIQ', 1, 1, 7)))
+
+
+class TestTrackers(unittest.TestCase):
+    def test_error_reply_does_not_abort_other_trackers(self):
+        async def get_peers():
+            loop = asyncio.get_running_loop()
+            urls = list()
+            transports = list()
+            for error in (True, False):
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: _FakeTracker(error),
+                    local_addr=('127.0.0.1', 0)
+                )
+                transports.append(transport)
+                urls.append('udp://127.0.0.1:%d/announce' % transport.get_extra_info('sockname')[1])
+            torrent = Torrent('x', 10, 10, 1, bytes(20), urls, [], [])
+            try:
+                return await Trackers(torrent, bytes(20), 10, 50).get_peers()
+            finally:
+                for transport in transports:
+                    transport.close()
+
+        self.assertEqual(asyncio.run(get_peers()), {IpAndPort('1.2.3.4', 6881)})
+
+
+if __name__ == '__main__':
+    unittest.main()